@@ -78,6 +78,8 @@ class TextResponse:
 
     """
 
+    __slots__ = ("next_token", "log_probabilities")
+
     def __init__(
         self,
         next_token: int | str,
@@ -298,6 +298,13 @@ class KVCacheManager(ABC):
             self.available.remove(seq_id)
             self.cache_lengths[seq_id] = 0
 
+    def external_claim_missing(self, seq_ids: Sequence[int]) -> None:
+        """Reserves the externally assigned `seq_ids` that are not yet in the
+        cache, claiming all of them with a single `external_claim` call."""
+        missing = [seq_id for seq_id in seq_ids if not self.contains(seq_id)]
+        if missing:
+            self.external_claim(missing)
+
     def _step(
         self,
         seq_ids_and_new_tokens: dict[int, np.ndarray],
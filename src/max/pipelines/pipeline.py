@@ -17,9 +17,12 @@ from __future__ import annotations
 
 import logging
 from abc import ABC, abstractmethod
-from dataclasses import dataclass
+from contextlib import contextmanager
+from dataclasses import dataclass, replace
+from operator import attrgetter
 from typing import (
     Generic,
+    Iterator,
     Optional,
     Protocol,
     Sequence,
@@ -28,6 +31,7 @@ from typing import (
     runtime_checkable,
 )
 
+import numpy as np
 import torch
 from max.driver import Device, Tensor
 from max.dtype import DType
@@ -52,16 +56,26 @@ from .interfaces import (
 from .kv_cache import KVCacheManager, KVCacheParams
 from .sampling import token_sampler
 
+
+@contextmanager
+def _without_new_root_handlers() -> Iterator[None]:
+    """Removes any handlers added to the root logger inside the block."""
+    root_logger = logging.getLogger()
+    handlers = list(root_logger.handlers)
+    try:
+        yield
+    finally:
+        for handler in list(root_logger.handlers):
+            if handler not in handlers:
+                root_logger.removeHandler(handler)
+
+
 try:
-    import xgrammar as xgr
-
-    # This retrieves the last logger handler added
-    # which presumably is the one initialized in xgrammar
-    # and removes it, this stops our server logging from
-    # doubling up.
-    logger = logging.getLogger()
-    handler = logger.handlers[-1]
-    logger.removeHandler(handler)
+    # xgrammar installs its own handler on the root logger when imported.
+    # Remove only the handlers added by the import, this stops our server
+    # logging from doubling up without touching anyone else's handlers.
+    with _without_new_root_handlers():
+        import xgrammar as xgr
 except ImportError:
     pass
 
@@ -138,6 +152,31 @@ class ModelOutputs:
 
 T = TypeVar("T", bound=InputContext)
 
+_batch_view_fields = attrgetter(
+    "cache_seq_id", "active_length", "current_length"
+)
+
+
+@dataclass(frozen=True)
+class _BatchView:
+    """Struct-of-arrays snapshot of the per-context lengths and ids read
+    while preparing a batch, indexed by position in the batch."""
+
+    cache_seq_ids: np.ndarray
+    active_lengths: np.ndarray
+    current_lengths: np.ndarray
+
+    @classmethod
+    def from_contexts(cls, batch: Sequence[InputContext]) -> _BatchView:
+        fields = np.array(
+            list(map(_batch_view_fields, batch)), dtype=np.int64
+        ).reshape(len(batch), 3)
+        return cls(
+            cache_seq_ids=fields[:, 0],
+            active_lengths=fields[:, 1],
+            current_lengths=fields[:, 2],
+        )
+
 
 class PipelineModel(ABC, Generic[T]):
     """A pipeline model with setup, input preparation and execution methods."""
@@ -374,19 +413,37 @@ class TextGenerationPipeline(TokenGenerator[T]):
                     msg = f"eos_token_id provided in huggingface config ({eos_tokens}), does not match provided eos_token_id ({eos_token_id}), using provided eos_token_id"
                     logger.warning(msg)
 
-                self._eos_token_id = set([eos_tokens])
+                self._eos_token_id = frozenset([eos_tokens])
             elif isinstance(eos_tokens, list):
                 if eos_token_id in eos_tokens:
-                    self._eos_token_id = set(eos_tokens)
+                    self._eos_token_id = frozenset(eos_tokens)
                 else:
-                    self._eos_token_id = set([eos_token_id])
+                    self._eos_token_id = frozenset([eos_token_id])
             else:
                 msg = f"eos_token_id in huggingface_config, is neither int or list: {eos_tokens}"
                 logger.warning(msg)
-                self._eos_token_id = set([eos_token_id])
+                self._eos_token_id = frozenset([eos_token_id])
 
         else:
-            self._eos_token_id = set([eos_token_id])
+            self._eos_token_id = frozenset([eos_token_id])
+
+        # Array form of the eos tokens, used to check a whole batch of
+        # generated tokens at once. Most models have a single eos token,
+        # which can be compared against directly. The tokenizer's eos token
+        # id may be None, which can never match a generated token.
+        eos_token_ids = [
+            token_id for token_id in self._eos_token_id if token_id is not None
+        ]
+        if not eos_token_ids:
+            logger.warning(
+                "No eos_token_id available for"
+                f" {pipeline_config.model_path}, generation will only stop at"
+                " the maximum length"
+            )
+        self._eos_array = np.array(eos_token_ids, dtype=np.int64)
+        self._eos_single: int | None = (
+            eos_token_ids[0] if len(eos_token_ids) == 1 else None
+        )
 
         # Create a grammar compiler if constrained decoding is enabled
         self.vocab_size = None
@@ -418,19 +475,46 @@ class TextGenerationPipeline(TokenGenerator[T]):
             pipeline_config=self._pipeline_config, session=session
         )
 
+        # The max sequence length only depends on the pipeline config, which
+        # does not change after init, so compute it once.
+        self._max_seq_len = self._pipeline_model.calculate_max_seq_len(
+            self._pipeline_config
+        )
+
         # Load sampler.
         self._sampler = session.load(
             token_sampler(self._pipeline_config.sampling_params),
         )
 
+        # Batches where no request has a grammar matcher skip the bitmask
+        # entirely, so structured output also needs the unmasked sampler.
+        self._unmasked_sampler = self._sampler
+        if self._pipeline_config.enable_structured_output:
+            self._unmasked_sampler = session.load(
+                token_sampler(
+                    replace(
+                        self._pipeline_config.sampling_params,
+                        enable_structured_output=False,
+                    )
+                ),
+            )
+
+        # Cleared the first time the model raises NotImplementedError from
+        # `compute_log_probabilities`, so later steps skip the call instead of
+        # raising and catching it on every step.
+        self._log_probabilities_supported = True
+
+        # Zero width generated tokens tensors, keyed by batch size. The sampler
+        # only reads these and returns a new tensor, so they can be reused by
+        # every `next_token` call instead of allocating one per call.
+        self._empty_generated_tokens: dict[int, Tensor] = {}
+
     def calculate_num_steps(
         self,
         num_steps: int,
         context: T,
     ) -> int:
-        max_seq_len = self._pipeline_model.calculate_max_seq_len(
-            self._pipeline_config
-        )
+        max_seq_len = self._max_seq_len
         # this is effectively: max_seq_len - (num_tokens_in_kv_cache + num_new_tokens) - num_new_tokens
         num_available_steps = max_seq_len - (
             context.current_length - context.active_length
@@ -446,33 +530,61 @@ class TextGenerationPipeline(TokenGenerator[T]):
             else num_available_steps
         )
 
-    @traced
+    def _calculate_num_steps_batch(
+        self,
+        num_steps: int,
+        batch_view: _BatchView,
+    ) -> int:
+        """Vectorized `calculate_num_steps` over every context in the batch."""
+        max_seq_len = self._max_seq_len
+        # this is effectively: max_seq_len - (num_tokens_in_kv_cache + num_new_tokens) - num_new_tokens
+        num_available_steps = max_seq_len - (
+            batch_view.current_lengths - batch_view.active_lengths
+        )
+        exhausted = np.flatnonzero(num_available_steps <= 0)
+        if exhausted.size > 0:
+            i = exhausted[0]
+            raise ValueError(
+                f"Request {batch_view.cache_seq_ids[i]} length ({batch_view.current_lengths[i]}) is larger than or equal to the configured max_length ({max_seq_len})"
+            )
+
+        return int(num_available_steps.min(initial=num_steps))
+
     def prepare_batch(
         self,
         batch: list[T],
         num_steps: int,
     ) -> tuple[ModelInputs, int, Optional[torch.Tensor]]:
+        return self._prepare_batch(
+            batch, _BatchView.from_contexts(batch), num_steps
+        )
+
+    @traced(message="prepare_batch")
+    def _prepare_batch(
+        self,
+        batch: list[T],
+        batch_view: _BatchView,
+        num_steps: int,
+    ) -> tuple[ModelInputs, int, Optional[torch.Tensor]]:
+        """`prepare_batch` with a view of the batch taken before `fetch`
+        shortens any prompts, so its active lengths are the untrimmed ones."""
         tracer: Tracer = Tracer("prepare_batch")
+        kv_manager = self._pipeline_model.kv_manager
+        structured_output = self._pipeline_config.enable_structured_output
 
-        if self._pipeline_config.enable_structured_output:
-            assert self.vocab_size is not None
-            bitmask = torch.ones(
-                xgr.get_bitmask_shape(
-                    len(batch),
-                    self.vocab_size,
-                ),
-                dtype=torch.int32,
-            )
-        else:
-            bitmask = None
+        # Update num_steps.
+        num_steps = self._calculate_num_steps_batch(num_steps, batch_view)
 
-        seq_ids_and_prompts = {}
-        seq_ids_and_untrimmed_lengths = {}
+        # Claim cache rows for any contexts not yet in the cache.
         tracer.next("claim_cache_rows")
-        for i, context in enumerate(batch):
+        kv_manager.external_claim_missing(batch_view.cache_seq_ids.tolist())
+
+        seq_ids_and_prompts = {}
+        tracer.next("gather_prompts")
+        for context in batch:
             # Initialize a matcher if needed
             if context.json_schema and context.matcher is None:
-                if not self._pipeline_config.enable_structured_output:
+                if not structured_output:
                     msg = "json_schema provided but constrained decoding is not enabled."
                     raise ValueError(msg)
 
@@ -492,50 +604,51 @@ class TextGenerationPipeline(TokenGenerator[T]):
                     # I am removing the json_schema, so it doesn't try to load the grammar repeatedly.
                     context.json_schema = None  # type: ignore
 
-            # Claim cache rows for context.
-            if not self._pipeline_model.kv_manager.contains(
-                context.cache_seq_id
-            ):
-                self._pipeline_model.kv_manager.external_claim(
-                    [context.cache_seq_id]
-                )
-
-            # Gather tokens and untrimmed lengths.
+            # Gather tokens.
             seq_ids_and_prompts[context.cache_seq_id] = context.next_tokens
-            seq_ids_and_untrimmed_lengths[context.cache_seq_id] = (
-                context.active_length
-            )
-
-            # Update num_steps.
-            num_steps = self.calculate_num_steps(num_steps, context)
 
-            # Update bitmask
-            if (
-                self._pipeline_config.enable_structured_output
-                and context.matcher
-            ):
-                context.matcher.fill_next_token_bitmask(bitmask, index=i)
+        # Only build a bitmask when some request in the batch is constrained,
+        # otherwise the unmasked sampler is used and no mask is needed.
+        bitmask: Optional[torch.Tensor] = None
+        if structured_output and any(context.matcher for context in batch):
+            tracer.next("fill_bitmask")
+            assert self.vocab_size is not None
+            # Every row is written below, either by its matcher or with the
+            # allow-all mask, so skip initializing the whole buffer.
+            bitmask = torch.empty(
+                xgr.get_bitmask_shape(
+                    len(batch),
+                    self.vocab_size,
+                ),
+                dtype=torch.int32,
+            )
+            for i, context in enumerate(batch):
+                if context.matcher:
+                    context.matcher.fill_next_token_bitmask(bitmask, index=i)
+                else:
+                    # All bits set allows every token.
+                    bitmask[i].fill_(-1)
 
         # `fetch` mutates the seq_ids_and_prompts input in place when tokens are
         # retrieved from the cache. This shortens the prompt in the event that
         # some tokens have backing KV cache entries.
         tracer.next("fetch_kv_cache")
-        kv_cache_inputs = self._pipeline_model.kv_manager.fetch(
-            seq_ids_and_prompts, num_steps
-        )
+        kv_cache_inputs = kv_manager.fetch(seq_ids_and_prompts, num_steps)
 
         # Update the context with the new possibly shortened prompt.
         tracer.next("trim_prompt")
-        for context in batch:
-            untrimmed_length = seq_ids_and_untrimmed_lengths[
-                context.cache_seq_id
-            ]
-            trimmed_length = len(seq_ids_and_prompts[context.cache_seq_id])
-            bump_length = untrimmed_length - trimmed_length
-            if bump_length > 0:
-                context.bump_token_indices(
-                    start_idx=bump_length,
-                )
+        # The prompts keep the batch order, so only the contexts whose prompt
+        # actually got shorter need to be visited.
+        trimmed_lengths = np.fromiter(
+            map(len, seq_ids_and_prompts.values()),
+            dtype=np.int64,
+            count=len(batch),
+        )
+        bump_lengths = batch_view.active_lengths - trimmed_lengths
+        for i in np.flatnonzero(bump_lengths > 0):
+            batch[i].bump_token_indices(
+                start_idx=int(bump_lengths[i]),
+            )
 
         return (
             self._pipeline_model.prepare_initial_token_inputs(
@@ -558,10 +671,7 @@ class TextGenerationPipeline(TokenGenerator[T]):
         if bitmask is not None:
             a, b = self._sampler(logits, prev_tokens, bitmask)[:2]
         else:
-            a, b = self._sampler(
-                logits,
-                prev_tokens,
-            )[:2]
+            a, b = self._unmasked_sampler(logits, prev_tokens)[:2]
         assert isinstance(a, Tensor)
         assert isinstance(b, Tensor)
         return (a, b)
@@ -587,18 +697,46 @@ class TextGenerationPipeline(TokenGenerator[T]):
             context.log_probabilities_echo for context in context_batch
         ]
 
+        # Gather the per-context ids and lengths once for the whole call.
+        batch_view = _BatchView.from_contexts(context_batch)
+
         # Prepare the batch.
-        model_inputs, num_steps, bitmask = self.prepare_batch(
-            context_batch, num_steps
+        model_inputs, num_steps, bitmask = self._prepare_batch(
+            context_batch, batch_view, num_steps
         )
 
         # Multistep execution loop.
         tracer.next("allocate_generated_tokens")
-        generated_tokens = Tensor.zeros(
-            (len(context_batch), 0),
-            dtype=DType.int64,
-            device=self._pipeline_config.devices[0],
-        )
+        device = self._pipeline_config.devices[0]
+        pipeline_model = self._pipeline_model
+        generated_tokens = self._empty_generated_tokens.get(len(context_batch))
+        if generated_tokens is None:
+            generated_tokens = Tensor.zeros(
+                (len(context_batch), 0),
+                dtype=DType.int64,
+                device=device,
+            )
+            self._empty_generated_tokens[len(context_batch)] = generated_tokens
+
+        # Unpack the bitmask and move it to the device once, ahead of the
+        # multistep loop, so the host to device copy is enqueued before the
+        # first execute instead of between execute and sampling.
+        device_bitmask: Optional[Tensor] = None
+        if bitmask is not None:
+            tracer.next("unpack_bitmask")
+            assert self.vocab_size is not None
+            # Token j is bit j % 32 of word j // 32. Once the words are stored
+            # little endian (a no-op on little endian hosts) that is bit j % 8
+            # of byte j // 8, so unpacking the bytes in little bit order
+            # writes one byte per token directly, without materializing a 32x
+            # expanded int32 intermediate.
+            unpacked_bitmask = np.unpackbits(
+                bitmask.numpy().astype("<i4", copy=False).view(np.uint8),
+                axis=1,
+                count=self.vocab_size,
+                bitorder="little",
+            ).view(np.bool_)
+            device_bitmask = Tensor.from_numpy(unpacked_bitmask).to(device)
 
         curr_step_inputs = model_inputs
         batch_log_probabilities = []
@@ -607,32 +745,18 @@ class TextGenerationPipeline(TokenGenerator[T]):
             tracer.push(f"step_{i}")
 
             # Execute the model and get next tokens.
-            model_outputs = self._pipeline_model.execute(
+            model_outputs = pipeline_model.execute(
                 model_inputs=curr_step_inputs,
             )
             assert model_outputs.next_token_logits is not None
             next_token_logits = model_outputs.next_token_logits
 
-            if bitmask is not None:
-                assert self.vocab_size is not None
-                bits = 2 ** torch.arange(32, dtype=torch.int32)
-                bitmask = (bitmask.unsqueeze(-1) & bits) != 0
-                bitmask = bitmask.reshape(
-                    len(context_batch),
-                    -1,
-                ).to(torch.bool)
-                bitmask = bitmask[:, 0 : self.vocab_size]
-
-                bitmask = Tensor.from_dlpack(bitmask).to(
-                    self._pipeline_config.devices[0]
-                )
-
             # Sample next token.
             tracer.next("sample_next_token")
             new_tokens, new_generated_tokens = self.sample_logits(
                 next_token_logits,
                 generated_tokens,
-                bitmask,
+                device_bitmask,
             )
 
             assert isinstance(new_tokens, Tensor)
@@ -640,23 +764,26 @@ class TextGenerationPipeline(TokenGenerator[T]):
             generated_tokens = new_generated_tokens
 
             if compute_log_probabilities:
-                try:
-                    tracer.next("compute_log_probabilities")
-                    batch_log_probabilities.append(
-                        self._pipeline_model.compute_log_probabilities(
-                            curr_step_inputs,
-                            model_outputs,
-                            new_tokens,
-                            batch_top_n,
-                            batch_echo,
+                tracer.next("compute_log_probabilities")
+                log_probabilities: list[LogProbabilities | None] | None = None
+                if self._log_probabilities_supported:
+                    try:
+                        log_probabilities = (
+                            pipeline_model.compute_log_probabilities(
+                                curr_step_inputs,
+                                model_outputs,
+                                new_tokens,
+                                batch_top_n,
+                                batch_echo,
+                            )
                         )
-                    )
-                except NotImplementedError:
-                    logger.warning(
-                        "Unable to compute log probabilities for"
-                        f" {self._pipeline_config.model_path}"
-                    )
-                    batch_log_probabilities.append(None)
+                    except NotImplementedError:
+                        logger.warning(
+                            "Unable to compute log probabilities for"
+                            f" {self._pipeline_config.model_path}"
+                        )
+                        self._log_probabilities_supported = False
+                batch_log_probabilities.append(log_probabilities)
             # Check if we're on our last iteration. If so, skip preparing the next batch
             if i == num_steps - 1:
                 tracer.pop()  # pops f"step_{i}"
@@ -673,85 +800,96 @@ class TextGenerationPipeline(TokenGenerator[T]):
                 curr_step_inputs.kv_cache_inputs.kv_cache_inputs, list
             ), "increment_cache_lengths instantiates and passes this as a list"
             curr_step_inputs.kv_cache_inputs.kv_cache_inputs = (
-                self._pipeline_model.kv_manager.increment_cache_lengths(
+                pipeline_model.kv_manager.increment_cache_lengths(
                     curr_step_inputs.kv_cache_inputs.kv_cache_inputs,
                     curr_step_inputs,
                 )
             )
 
             tracer.next("prepare_next_token_inputs")  # pops inc_cache_lengths
-            curr_step_inputs = self._pipeline_model.prepare_next_token_inputs(
+            curr_step_inputs = pipeline_model.prepare_next_token_inputs(
                 new_tokens, curr_step_inputs
             )
             tracer.pop()  # pops step_{i}
 
-        # Do the copy to host for each token generated.
+        # Set up everything in the response that does not depend on the
+        # generated tokens. Execution is asynchronous, so this host work
+        # overlaps with the steps still running on the device, ahead of the
+        # blocking copy below.
         tracer.next(
-            "generated_tokens.to(CPU())"
+            "prepare_response_setup"
         )  # pops multistep_execution_loop_steps
+        seq_ids = batch_view.cache_seq_ids.tolist()
+        max_lengths = [
+            upper_bounded_default(
+                upper_bound=self._max_seq_len,
+                default=ctx.max_length,
+            )
+            for ctx in context_batch
+        ]
+        res: dict[str, TextGenerationResponse] = {
+            request_id: TextGenerationResponse([], TextGenerationStatus.ACTIVE)
+            for request_id in batch
+        }
+
+        # Do the copy to host for each token generated.
+        tracer.next("generated_tokens.to(CPU())")  # pops prepare_response_setup
         generated_tokens_host = generated_tokens.to_numpy()
 
         # Actually update the cache lengths in our kv_cache manager
         tracer.next("kv_manager.step")  # pops generated_tokens.to(CPU())
-        seq_ids_and_new_tokens = {
-            ctx.cache_seq_id: generated_tokens_host[i]
-            for i, ctx in enumerate(context_batch)
-        }
-        self._pipeline_model.kv_manager.step(seq_ids_and_new_tokens)
+        # Iterating the host array yields one row view per sequence, so no
+        # per-element indexing is needed to build the mapping.
+        seq_ids_and_new_tokens = dict(zip(seq_ids, generated_tokens_host))
+        pipeline_model.kv_manager.step(seq_ids_and_new_tokens)
         tracer.pop()  # pops kv_manager.step
 
         # Prepare the response, pruning away completed requests as we go.
-        res: dict[str, TextGenerationResponse] = {}
         tracer.push("prepare_response")
+        # Find the first eos step of each request in one vectorized pass,
+        # falling back to num_steps for requests that did not hit eos.
+        if self._eos_single is not None:
+            eos_hits = generated_tokens_host == self._eos_single
+        else:
+            eos_hits = np.isin(generated_tokens_host, self._eos_array)
+        eos_steps = np.where(
+            eos_hits.any(axis=1), eos_hits.argmax(axis=1), num_steps
+        ).tolist()
         for batch_index, (request_id, context) in enumerate(batch.items()):
-            status = TextGenerationStatus.ACTIVE
-            res[request_id] = TextGenerationResponse([], status)
-            for step in range(num_steps):
-                # Convert to a Python scalar to improve serialization performance.
-                next_token = int(generated_tokens_host[batch_index, step])
-
+            response = res[request_id]
+            max_length = max_lengths[batch_index]
+            eos_step = eos_steps[batch_index]
+            # Only visit the tokens up to the first eos, converted to Python
+            # scalars in one call to improve serialization performance.
+            tokens = generated_tokens_host[batch_index, : eos_step + 1].tolist()
+            for step, next_token in enumerate(tokens):
                 # Write this token into our pre-allocated tokens array.
                 context.update(
                     new_token=next_token,
                 )
 
-                max_length = upper_bounded_default(
-                    upper_bound=self._pipeline_model.calculate_max_seq_len(
-                        self._pipeline_config
-                    ),
-                    default=context.max_length,
-                )
-
-                # Set up TextResponse
-                log_probs: Optional[LogProbabilities] = None
-                if compute_log_probabilities and (
-                    log_probs_for_step := batch_log_probabilities[step]
-                ):
-                    log_probs = log_probs_for_step[batch_index]
-
                 # Update status
                 # If its eos, dont add it to the token array.
-                if next_token in self._eos_token_id:
-                    status = TextGenerationStatus.END_OF_SEQUENCE
-                    res[request_id].update_status(status)
-                elif context.current_length == max_length:
-                    status = TextGenerationStatus.MAXIMUM_LENGTH
-                    res[request_id].append_token(
-                        TextResponse(next_token, log_probs)
-                    )
-                    res[request_id].update_status(status)
+                if step == eos_step:
+                    response.update_status(TextGenerationStatus.END_OF_SEQUENCE)
+                    break
                 # This practically, should not be hit, as once the context object
                 # reaches the max_length, we should break from this current loop.
                 # TODO: Explore cleaning up max length checks.
                 elif context.current_length > max_length:
-                    status = TextGenerationStatus.MAXIMUM_LENGTH
-                    res[request_id].update_status(status)
-                else:
-                    res[request_id].append_token(
-                        TextResponse(next_token, log_probs)
-                    )
+                    response.update_status(TextGenerationStatus.MAXIMUM_LENGTH)
+                    break
+
+                # Set up TextResponse, only for tokens that are emitted.
+                log_probs: Optional[LogProbabilities] = None
+                if compute_log_probabilities and (
+                    log_probs_for_step := batch_log_probabilities[step]
+                ):
+                    log_probs = log_probs_for_step[batch_index]
+                response.append_token(TextResponse(next_token, log_probs))
 
-                if status.is_done:
+                if context.current_length == max_length:
+                    response.update_status(TextGenerationStatus.MAXIMUM_LENGTH)
                     break
 
         return res
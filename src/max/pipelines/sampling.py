@@ -18,25 +18,30 @@ from max.graph import Dim, Graph, Shape, TensorType, TensorValue, ops
 from max.pipelines import SamplingParams
 
 
-def _bitmask_sampler(sampling_params: SamplingParams) -> Graph:
+def _sampler(sampling_params: SamplingParams, use_bitmask: bool) -> Graph:
+    """Builds the token sampling graph, optionally masking the logits with a
+    bitmask before the fused top-k sampling."""
     logits_in_type = TensorType(
         sampling_params.in_dtype, ["batch", "vocab_size"]
     )
     prev_tokens_type = TensorType(DType.int64, ["batch", "num_prev_steps"])
-    bitmask_type = TensorType(DType.bool, ["batch", "vocab_size"])
+    input_types = [logits_in_type, prev_tokens_type]
+    if use_bitmask:
+        input_types.append(TensorType(DType.bool, ["batch", "vocab_size"]))
 
     with Graph(
-        "bitmask_sampler",
-        input_types=[logits_in_type, prev_tokens_type, bitmask_type],
+        "bitmask_sampler" if use_bitmask else "token_sampler",
+        input_types=input_types,
     ) as graph:
         # Deconstruct inputs and cast.
-        logits, prev_tokens, bitmask = (val.tensor for val in graph.inputs)
+        logits, prev_tokens, *bitmask = (val.tensor for val in graph.inputs)
         logits = ops.cast(logits, sampling_params.out_dtype)
 
         # Mask the logits out.
-        logits = ops.select(
-            bitmask, logits, ops.constant(-10000, dtype=DType.float32)
-        )
+        if bitmask:
+            logits = ops.select(
+                bitmask[0], logits, ops.constant(-10000, dtype=DType.float32)
+            )
 
         # Apply top_k or argmax sampling.
         shape = Shape(logits.shape)
@@ -58,38 +63,8 @@ def _bitmask_sampler(sampling_params: SamplingParams) -> Graph:
         return graph
 
 
-def _vanilla_sampler(sampling_params: SamplingParams) -> Graph:
-    logits_in_type = TensorType(
-        sampling_params.in_dtype, ["batch", "vocab_size"]
-    )
-    prev_tokens_type = TensorType(DType.int64, ["batch", "num_prev_steps"])
-    with Graph(
-        "token_sampler", input_types=[logits_in_type, prev_tokens_type]
-    ) as graph:
-        logits, prev_tokens = (val.tensor for val in graph.inputs)
-        logits = ops.cast(logits, sampling_params.out_dtype)
-
-        shape = Shape(logits.shape)
-        shape[-1] = Dim(1)
-        tokens = ops.custom(
-            "topk_fused_sampling",
-            [
-                ops.constant(sampling_params.top_k, dtype=DType.int64),
-                logits,
-            ],
-            [TensorType(DType.int64, shape)],
-        )[0]
-        assert isinstance(tokens, TensorValue)
-
-        all_tokens = ops.concat([prev_tokens, tokens], -1)
-        tokens = ops.squeeze(tokens, -1)
-        graph.output(tokens, all_tokens)
-
-        return graph
-
-
 def token_sampler(sampling_params: SamplingParams) -> Graph:
-    if sampling_params.enable_structured_output:
-        return _bitmask_sampler(sampling_params)
-    else:
-        return _vanilla_sampler(sampling_params)
+    return _sampler(
+        sampling_params,
+        use_bitmask=sampling_params.enable_structured_output,
+    )